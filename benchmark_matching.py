@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from getpass import getpass
+import json
+from os import path, replace
+from time import perf_counter
+
+import spotipy
+
+from json2spotify import Song, find_track, progress_bar, search_passes
+from spotify_auth import authenticate
+
+
+CORPUS_FILE_NAME = 'matching_corpus.json'
+
+
+def trim_result(result):
+    # only keep the fields that pick_best_result actually looks at so the corpus stays reasonably sized
+    return {
+        'tracks': {
+            'total': result['tracks']['total'],
+            'items': [
+                {
+                    'id': track['id'],
+                    'name': track['name'],
+                    'artists': [{'name': artist['name']} for artist in track['artists']],
+                    'album': {'name': track['album']['name']},
+                } for track in result['tracks']['items']
+            ],
+        }
+    }
+
+
+class RecordingSearcher:
+    def __init__(self, spotify):
+        self.spotify = spotify
+        self.responses = {}
+
+    def search(self, q, type='track'):
+        result = trim_result(self.spotify.search(q, type=type))
+        self.responses[q] = result
+        return result
+
+
+class ReplaySearcher:
+    EMPTY_RESULT = {'tracks': {'total': 0, 'items': []}}
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = 0
+        self.misses = 0
+
+    def search(self, q, type='track'):
+        self.calls += 1
+
+        if q not in self.responses:
+            # the heuristics issued a query we have no recording for, so treat it as if Spotify found nothing
+            self.misses += 1
+            return ReplaySearcher.EMPTY_RESULT
+
+        return self.responses[q]
+
+
+def record_corpus(username, client_id, client_secret, json_input, corpus_path, limit=None):
+    # hand-checked expected IDs are what precision/recall depend on, so carry over anything already in the corpus
+    existing = OrderedDict()
+
+    if path.isfile(corpus_path):
+        with open(corpus_path, 'r') as corpus_file:
+            for entry in json.load(corpus_file)['songs']:
+                existing[entry['id']] = entry
+
+        print("Keeping expected IDs from %d existing corpus entries." % len(existing))
+
+    token = authenticate(username, client_id, client_secret, 'user-library-read')
+
+    print("Creating Spotify API instance...")
+
+    spotify = spotipy.Spotify(auth=token)
+
+    print("Loading library JSON...")
+
+    song_list = list(json.load(json_input)['songs'].items())
+
+    if limit is not None:
+        song_list = song_list[:limit]
+
+    print("Recording search responses for %d songs..." % len(song_list))
+
+    for i, (uuid, serial) in enumerate(song_list):
+        progress_bar(i + 1, len(song_list))
+
+        song = Song(uuid, serial['artist'], serial['title'], serial['album'], serial['in_library'])
+
+        searcher = RecordingSearcher(spotify)
+
+        # record every pass, even the ones find_track wouldn't get to, so that a change which rejects an earlier
+        # pass's result can still be replayed against the later ones
+        for query, artist, title in search_passes(song):
+            if query not in searcher.responses:
+                searcher.search(query, type='track')
+
+        track = find_track(ReplaySearcher(searcher.responses), song)
+
+        entry = {
+            'id': uuid,
+            'artist': song.artist,
+            'title': song.title,
+            'album': song.album,
+            # this is only what the current heuristics picked, so it's left out of precision/recall until someone
+            # has checked it by hand and set reviewed to true
+            'expected_id': track['id'] if track else None,
+            'reviewed': False,
+            'responses': searcher.responses,
+        }
+
+        if uuid in existing:
+            entry['expected_id'] = existing[uuid]['expected_id']
+            entry['reviewed'] = existing[uuid].get('reviewed', False)
+
+        existing[uuid] = entry
+
+    print()
+
+    entries = list(existing.values())
+
+    # write to a temporary file first so a failure partway through doesn't clobber the existing corpus
+    temp_path = corpus_path + '.tmp'
+
+    with open(temp_path, 'w') as corpus_file:
+        json.dump({'songs': entries}, corpus_file, indent=2)
+
+    replace(temp_path, corpus_path)
+
+    print("Wrote %d corpus entries. Review the expected IDs and mark them as reviewed before relying on precision/recall."
+          % len(entries))
+
+
+def replay_corpus(corpus, iterations=1):
+    entries = corpus['songs']
+
+    songs = [
+        (Song(entry['id'], entry['artist'], entry['title'], entry['album'], True), entry)
+        for entry in entries
+    ]
+
+    calls = 0
+    misses = 0
+    matches = 0
+    reviewed = 0
+    true_pos = 0
+    false_pos = 0
+    expected = 0
+
+    elapsed = 0
+
+    for i in range(0, iterations):
+        for song, entry in songs:
+            searcher = ReplaySearcher(entry['responses'])
+
+            start = perf_counter()
+            track = find_track(searcher, song)
+            elapsed += perf_counter() - start
+
+            # accuracy doesn't change between iterations, so only tally it once
+            if i != 0:
+                continue
+
+            calls += searcher.calls
+            misses += searcher.misses
+
+            actual_id = track['id'] if track else None
+
+            if actual_id is not None:
+                matches += 1
+
+            # unreviewed expected IDs just come from the heuristics themselves, so they say nothing about accuracy
+            if not entry.get('reviewed', False):
+                continue
+
+            reviewed += 1
+
+            expected_id = entry['expected_id']
+
+            if expected_id is not None:
+                expected += 1
+
+            if actual_id is None:
+                continue
+
+            if actual_id == expected_id:
+                true_pos += 1
+            else:
+                false_pos += 1
+
+    return {
+        'songs': len(songs),
+        'matches': matches,
+        'reviewed': reviewed,
+        'songs_per_sec': len(songs) * iterations / elapsed if elapsed > 0 else float('inf'),
+        'searches_per_song': float(calls) / len(songs) if len(songs) > 0 else 0,
+        'unrecorded_searches': misses,
+        'precision': float(true_pos) / (true_pos + false_pos) if true_pos + false_pos > 0 else None,
+        'recall': float(true_pos) / expected if expected > 0 else None,
+    }
+
+
+def format_ratio(ratio):
+    return "%.2f%%" % (ratio * 100) if ratio is not None else "n/a"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Record or replay an offline corpus for benchmarking the matching heuristics.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help="record Spotify search responses for songs in the library")
+    record_parser.add_argument('--input', default='output_library.json', help="library JSON to sample songs from")
+    record_parser.add_argument('--limit', type=int, help="maximum number of songs to record")
+    record_parser.add_argument('--corpus', default=CORPUS_FILE_NAME, help="file to write the corpus to")
+
+    replay_parser = subparsers.add_parser('replay', help="run the matching heuristics against a recorded corpus")
+    replay_parser.add_argument('--corpus', default=CORPUS_FILE_NAME, help="corpus file to replay")
+    replay_parser.add_argument('--iterations', type=int, default=5, help="number of passes to time over the corpus")
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        user = input('Spotify username: ')
+        client_id = input('Spotify client ID: ')
+        client_secret = getpass('Spotify client secret: ')
+
+        with open(args.input, 'r') as json_file:
+            record_corpus(user, client_id, client_secret, json_file, args.corpus, args.limit)
+    else:
+        with open(args.corpus, 'r') as corpus_file:
+            stats = replay_corpus(json.load(corpus_file), args.iterations)
+
+        print("Songs:               %d (%d reviewed)" % (stats['songs'], stats['reviewed']))
+        print("Matched:             %d" % stats['matches'])
+        print("Songs/sec:           %.1f" % stats['songs_per_sec'])
+        print("Searches per song:   %.2f" % stats['searches_per_song'])
+        print("Unrecorded searches: %d" % stats['unrecorded_searches'])
+        print("Precision:           %s" % format_ratio(stats['precision']))
+        print("Recall:              %s" % format_ratio(stats['recall']))
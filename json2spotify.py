@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
+from argparse import ArgumentParser
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from datetime import datetime, time, timedelta
 from difflib import SequenceMatcher
@@ -8,11 +10,14 @@ from getpass import getpass
 import json
 from math import ceil
 from os import path
+from queue import Queue
 import re
 from sys import stdout
+from threading import Thread, local
 from uuid import UUID
 
 import spotipy
+from spotipy import SpotifyException
 from spotipy.util import prompt_for_user_token
 
 from spotify_auth import authenticate
@@ -21,6 +26,21 @@ from spotify_auth import authenticate
 # the minimum similarity for an artist to be considered correct with respect to the target
 ARTIST_MATCH_THRESHOLD = 0.5
 
+# the maximum number of tracks Spotify accepts in a single library/playlist modification or track lookup request
+PER_REQUEST = 50
+
+# cached local ID -> Spotify ID mappings from a previous run
+MAPPINGS_FILE_NAME = 'spotify_mappings.csv'
+
+# the number of track lookup requests to have in flight at once when validating cached mappings
+VALIDATION_WORKERS = 8
+
+# assumptions used when estimating how long an import will take
+# the average round trip for a single API request, in seconds
+REQUEST_LATENCY = 0.5
+# the number of requests per second we expect Spotify to allow before rate limiting us
+RATE_LIMIT = 10
+
 ########
 # Regexes for transforming track/artist names to increase chance of matching
 ########
@@ -70,6 +90,102 @@ class Playlist:
             self.songs.append(song)
 
 
+# Writes matched songs to the Spotify library and playlists on a background thread while matching is still in
+# progress. Saved tracks are flushed as soon as a full request's worth is available, and each playlist is created and
+# filled as soon as every song in it has either been matched or failed to match.
+class LibraryWriter:
+    def __init__(self, spotify, username, playlists):
+        self.spotify = spotify
+        self.username = username
+        self.playlists = playlists
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.error = None
+
+        # everything below is only touched by the writer thread
+        self.spotify_ids = {}
+        self.saved_ids = set()
+        self.pending_saved = []
+        self.unresolved = {}
+        self.saved_count = 0
+        self.playlist_count = 0
+
+    def start(self):
+        self.thread.start()
+
+    def failed(self):
+        # lets the matching loop stop straight away rather than after matching has run to completion
+        return self.error is not None
+
+    def resolve(self, song, spotify_id):
+        # spotify_id is None if the song couldn't be matched
+        self.queue.put((song, spotify_id))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            for playlist in self.playlists:
+                if len(playlist.songs) == 0:
+                    self._write_playlist(playlist)
+                else:
+                    self.unresolved[playlist] = len(playlist.songs)
+
+            while True:
+                item = self.queue.get()
+
+                if item is None:
+                    break
+
+                self._handle(*item)
+
+            self._flush_saved()
+        except Exception as e:
+            self.error = e
+
+    def _handle(self, song, spotify_id):
+        if spotify_id is not None:
+            self.spotify_ids[song.id] = spotify_id
+
+            if song.in_library and spotify_id not in self.saved_ids:
+                self.saved_ids.add(spotify_id)
+                self.pending_saved.append(spotify_id)
+
+                if len(self.pending_saved) >= PER_REQUEST:
+                    self._flush_saved()
+
+        for playlist in unique(song.playlists):
+            self.unresolved[playlist] -= 1
+
+            if self.unresolved[playlist] == 0:
+                del self.unresolved[playlist]
+                self._write_playlist(playlist)
+
+    def _flush_saved(self):
+        if len(self.pending_saved) == 0:
+            return
+
+        self.spotify.current_user_saved_tracks_add(self.pending_saved)
+
+        self.saved_count += len(self.pending_saved)
+        self.pending_saved = []
+
+    def _write_playlist(self, playlist):
+        playlist_id = self.spotify.user_playlist_create(self.username, playlist.name, public=False)['id']
+
+        track_ids = [self.spotify_ids[song.id] for song in playlist.songs if song.id in self.spotify_ids]
+
+        for i in range(0, len(track_ids), PER_REQUEST):
+            self.spotify.user_playlist_add_tracks(self.username, playlist_id, track_ids[i:(i + PER_REQUEST)])
+
+        self.playlist_count += 1
+
+
 def progress_bar(value, endvalue, eta=-1, bar_length=20):
     percent = float(value) / endvalue
     eta_str = (datetime.min + timedelta(seconds=eta)).time().strftime('%H:%M:%S') if eta != -1 else '???'
@@ -141,13 +257,176 @@ def pick_best_result(artist, title, album, result):
     return best_match
 
 
-def import_library_from_json(username, client_id, client_secret, json_input):
-    library_mod_token = authenticate(username, client_id, client_secret, 'user-library-modify playlist-modify-private')
+def search_passes(song):
+    artist = song.artist
+    title = song.title
 
-    print("Creating Spotify API instance...")
+    sanitized_artist = sanitize_artist(artist)
+    sanitized_title = sanitize_title(title)
 
-    spotify = spotipy.Spotify(auth=library_mod_token)
+    # each pass is the query to send along with the artist and title to match the results against
+    return [
+        # pass the artist and title as-is
+        ('artist:%s track:%s' % (artist, title), artist, title),
+        # transform the artist and title
+        ('artist:%s track:%s' % (sanitized_artist, sanitized_title), sanitized_artist, sanitized_title),
+        # search by song title only, then match the artist after the fact
+        ('track:%s' % sanitized_title, sanitized_artist, sanitized_title),
+    ]
+
+
+def find_track(spotify, song):
+    # We have three different levels of heuristics which we use to match tracks:
+    #   1) Pass the artist and title as-is, and hope Spotify turns something up.
+    #   2) Transform the artist and title, then pass them on to spotify. This
+    #      resolves issues with minor formatting differences and special characters.
+    #   3) Pass only the transformed title, then manually match the artist against
+    #      the returned results. This is a last-resort, as it is only accurate in
+    #      cases where the first two searches fail.
+    # The reason for executing all heuristics is that each fails in certain cases,
+    # and by executing all three, we ensure that the maximum number of tracks are
+    # matched. Unfortunately, this means sacrificing speed for accuracy, since
+    # Spotify is really slow at returning search results.
+
+    for query, artist, title in search_passes(song):
+        result = spotify.search(query, type='track')
+
+        track = pick_best_result(artist, title, song.album, result)
+
+        if track:
+            return track
+
+    return None
+
+
+def write_unmatched(failed_songs):
+    unmatched_json = {
+        'songs': [
+            {
+                'artist': song.artist,
+                'title': song.title,
+                'album': song.album,
+                'in_playlists': [pl.name for pl in song.playlists],
+            } for song in failed_songs
+        ]
+    }
+
+    with open('unmatched.json', 'w') as unmatched_file:
+        json.dump(unmatched_json, unmatched_file, indent=2)
+
+    print("Wrote unmatched song info to unmatched.json.")
+
+
+def lookup_tracks(spotify, track_ids):
+    # market=from_token makes Spotify relink tracks which aren't available in the user's country and report whether
+    # they're playable at all
+    try:
+        return spotify.tracks(track_ids, market='from_token')['tracks']
+    except SpotifyException as e:
+        # anything other than a malformed ID (e.g. rate limiting or a server error) says nothing about whether the
+        # cached IDs are valid, so let it propagate rather than throwing away good mappings
+        if e.http_status != 400:
+            raise
+
+    # one malformed ID fails the whole request, so fall back to looking the chunk up one track at a time
+    tracks = []
+
+    for track_id in track_ids:
+        try:
+            tracks.append(spotify.track(track_id, market='from_token'))
+        except SpotifyException as e:
+            if e.http_status not in (400, 404):
+                raise
+
+            tracks.append(None)
+
+    return tracks
+
+
+def validate_mappings(spotify, songs, spotify_ids, client_factory):
+    mapped_ids = list(spotify_ids.items())
+
+    chunks = [mapped_ids[i:(i + PER_REQUEST)] for i in range(0, len(mapped_ids), PER_REQUEST)]
+
+    print("Validating %d cached mappings in %d requests..." % (len(mapped_ids), len(chunks)))
+
+    # each worker gets its own client so they aren't all sharing a session
+    clients = local()
+
+    def lookup_chunk(chunk):
+        if not hasattr(clients, 'spotify'):
+            clients.spotify = client_factory()
+
+        return lookup_tracks(clients.spotify, [v for k, v in chunk])
+
+    with ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as executor:
+        results = executor.map(lookup_chunk, chunks)
+
+        relinked = 0
+        invalid = []
+
+        for chunk, tracks in zip(chunks, results):
+            for (local_id, spotify_id), track in zip(chunk, tracks):
+                if track is None or not track.get('is_playable', True):
+                    # the track was removed or can't be played here, so it needs to be searched for again
+                    invalid.append(local_id)
+                elif track['id'] != spotify_id:
+                    # Spotify relinked the track to another copy of it, so just point the mapping at that instead
+                    spotify_ids[local_id] = track['id']
+                    relinked += 1
+
+    print("Relinked %d mappings." % relinked)
+    print("Found %d invalid mappings." % len(invalid))
+
+    if len(invalid) == 0:
+        return
+
+    print("Re-matching invalid mappings on Spotify...")
+
+    rematched = 0
+    failed = 0
+    dropped = 0
+
+    for i, local_id in enumerate(invalid):
+        progress_bar(i + 1, len(invalid))
+
+        del spotify_ids[local_id]
+
+        # the export may have changed since the mappings were written
+        if UUID(local_id) not in songs:
+            dropped += 1
+            continue
+
+        track = find_track(spotify, songs[UUID(local_id)])
+
+        if not track:
+            failed += 1
+            continue
+
+        spotify_ids[local_id] = track['id']
+        rematched += 1
+
+    print()
 
+    print("Re-matched %d tracks on Spotify." % rematched)
+    print("Failed to re-match %d tracks." % failed)
+
+    if dropped > 0:
+        print("Dropped %d mappings for songs no longer in the library." % dropped)
+
+
+def read_mappings():
+    spotify_ids = {}
+
+    with open(MAPPINGS_FILE_NAME, 'r') as mappings_file:
+        reader = csv.reader(mappings_file)
+        for row in reader:
+            spotify_ids[row[0]] = row[1]
+
+    return spotify_ids
+
+
+def load_library(json_input):
     print("Loading library JSON...")
 
     library_json = json.load(json_input)
@@ -178,6 +457,115 @@ def import_library_from_json(username, client_id, client_secret, json_input):
 
     print("Successfully imported %d playlists." % len(playlists))
 
+    return songs, playlists
+
+
+def format_duration(seconds):
+    seconds = int(ceil(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def estimate_time(requests, concurrency=1):
+    # requests are bound either by how many we can have in flight or by the rate limit, whichever is slower
+    return requests * max(REQUEST_LATENCY / concurrency, 1.0 / RATE_LIMIT)
+
+
+def plan_import(json_input, pipelined=False, validate=False):
+    songs, playlists = load_library(json_input)
+
+    spotify_ids = {}
+
+    if path.isfile(MAPPINGS_FILE_NAME):
+        print("Using local mappings file.")
+        spotify_ids = read_mappings()
+
+    in_library = [song for song in songs.values() if song.in_library]
+
+    lookups = 0
+
+    if len(spotify_ids) > 0:
+        # the mappings are used as-is, so the only searches are for mappings which turn out to be invalid
+        if validate:
+            lookups = ceil(len(spotify_ids) / PER_REQUEST)
+
+        min_searches = 0
+        max_searches = 3 * len(spotify_ids) if validate else 0
+
+        # we know exactly which tracks will be written, barring any which fail validation
+        saved_ids = unique([spotify_ids[song.id] for song in in_library if song.id in spotify_ids])
+        max_saved_batches = ceil(len(saved_ids) / PER_REQUEST)
+        min_saved_batches = 0 if validate else max_saved_batches
+
+        playlist_tracks = [len([song for song in pl.songs if song.id in spotify_ids]) for pl in playlists]
+        max_playlist_adds = sum(ceil(count / PER_REQUEST) for count in playlist_tracks)
+        min_playlist_adds = 0 if validate else max_playlist_adds
+    else:
+        # the first heuristic matches every song in the best case, and every song falls through to the last one in
+        # the worst case
+        min_searches = len(songs)
+        max_searches = 3 * len(songs)
+
+        # in the worst case nothing matches and nothing gets written; in the best case every song matches a distinct
+        # track
+        min_saved_batches = 0
+        max_saved_batches = ceil(len(in_library) / PER_REQUEST)
+
+        min_playlist_adds = 0
+        max_playlist_adds = sum(ceil(len(pl.songs) / PER_REQUEST) for pl in playlists)
+
+    playlist_creates = len(playlists)
+
+    lookup_time = estimate_time(lookups, VALIDATION_WORKERS)
+
+    def total_time(searches, writes):
+        search_time = estimate_time(searches)
+        write_time = estimate_time(writes)
+
+        # in pipelined mode the writes happen while we're still searching, but both still share the one rate limit
+        if pipelined:
+            return lookup_time + max(search_time, write_time, float(searches + writes) / RATE_LIMIT)
+
+        return lookup_time + search_time + write_time
+
+    max_writes = max_saved_batches + playlist_creates + max_playlist_adds
+
+    # the fewest searches only happens when every song matches on the first pass, so every write is still made; on
+    # the other end, songs can go through every pass and still match on the last one
+    best_time = total_time(min_searches, max_writes)
+    worst_time = total_time(max_searches, max_writes)
+
+    print()
+    print("Import plan (dry run, no changes will be made):")
+    print("  Songs:                  %d (%d in library)" % (len(songs), len(in_library)))
+    print("  Cached mappings:        %d" % len(spotify_ids))
+    print("  Track lookup requests:  %d" % lookups)
+    print("  Searches:               %d - %d" % (min_searches, max_searches))
+    print("  Saved track batches:    %d - %d" % (min_saved_batches, max_saved_batches))
+    print("  Playlist creations:     %d" % playlist_creates)
+    print("  Playlist add requests:  %d - %d" % (min_playlist_adds, max_playlist_adds))
+    print("  Estimated time:         %s - %s" % (format_duration(best_time), format_duration(worst_time)))
+    print("    (assuming %.2fs per request, at most %d requests/sec, %d concurrent lookups%s)"
+          % (REQUEST_LATENCY, RATE_LIMIT, VALIDATION_WORKERS, ', pipelined writes' if pipelined else ''))
+
+    return {
+        'lookups': lookups,
+        'searches': (min_searches, max_searches),
+        'saved_batches': (min_saved_batches, max_saved_batches),
+        'playlist_creates': playlist_creates,
+        'playlist_adds': (min_playlist_adds, max_playlist_adds),
+        'time': (best_time, worst_time),
+    }
+
+
+def import_library_from_json(username, client_id, client_secret, json_input, pipelined=False, validate=False):
+    library_mod_token = authenticate(username, client_id, client_secret, 'user-library-modify playlist-modify-private')
+
+    print("Creating Spotify API instance...")
+
+    spotify = spotipy.Spotify(auth=library_mod_token)
+
+    songs, playlists = load_library(json_input)
+
     spotify_ids = {}
 
     found = 0
@@ -185,14 +573,39 @@ def import_library_from_json(username, client_id, client_secret, json_input):
 
     failed_songs = []
 
-    MAPPINGS_FILE_NAME = 'spotify_mappings.csv'
+    library_writer = None
+
+    if pipelined:
+        print("Streaming matched songs to Spotify library and playlists as they are resolved.")
+
+        # the writer gets its own client so it isn't sharing a session with the matching thread
+        library_writer = LibraryWriter(spotipy.Spotify(auth=library_mod_token), username, playlists)
+        library_writer.start()
 
     if path.isfile(MAPPINGS_FILE_NAME):
         print("Using local mappings file.")
-        with open(MAPPINGS_FILE_NAME, 'r') as mappings_file:
-            reader = csv.reader(mappings_file)
-            for row in reader:
-                spotify_ids[row[0]] = row[1]
+        spotify_ids = read_mappings()
+
+        if validate:
+            validate_mappings(spotify, songs, spotify_ids, lambda: spotipy.Spotify(auth=library_mod_token))
+
+            # this includes songs which failed to match on the original run, since they never had a mapping
+            failed_songs = [song for song in songs.values() if song.id not in spotify_ids]
+
+            if len(failed_songs) > 0:
+                write_unmatched(failed_songs)
+
+            with open(MAPPINGS_FILE_NAME, 'w+') as mappings_file:
+                writer = csv.writer(mappings_file)
+
+                for k, v in spotify_ids.items():
+                    writer.writerow([k, v])
+
+                print("Wrote validated Spotify ID mappings to %s." % MAPPINGS_FILE_NAME)
+
+        if library_writer is not None:
+            for song in songs.values():
+                library_writer.resolve(song, spotify_ids.get(song.id))
     else:
         print("Matching songs on Spotify...")
 
@@ -205,6 +618,12 @@ def import_library_from_json(username, client_id, client_secret, json_input):
 
         eta = 0
         for local_id, song in songs.items():
+            if library_writer is not None and library_writer.failed():
+                # stop searching, but still save what we've matched so far before the error is raised below
+                print()
+                print("A library or playlist write failed; stopping after matching %d of %d songs." % (i, len(songs)))
+                break
+
             i += 1
 
             if last_search is not None:
@@ -225,49 +644,23 @@ def import_library_from_json(username, client_id, client_secret, json_input):
 
             progress_bar(i, len(songs), eta)
 
-            artist = song.artist
-            title = song.title
-            album = song.album
-
-            # We have three different levels of heuristics which we use to match tracks:
-            #   1) Pass the artist and title as-is, and hope Spotify turns something up.
-            #   2) Transform the artist and title, then pass them on to spotify. This
-            #      resolves issues with minor formatting differences and special characters.
-            #   3) Pass only the transformed title, then manually match the artist against
-            #      the returned results. This is a last-resort, as it is only accurate in
-            #      cases where the first two searches fail.
-            # The reason for executing all heuristics is that each fails in certain cases,
-            # and by executing all three, we ensure that the maximum number of tracks are
-            # matched. Unfortunately, this means sacrificing speed for accuracy, since
-            # Spotify is really slow at returning search results.
-
-            result = spotify.search('artist:%s track:%s' % (artist, title), type='track')
-
-            track = pick_best_result(artist, title, album, result)
-
-            if not track:
-                # we'll try transforming the artist and title
-                artist = sanitize_artist(artist)
-                title = sanitize_title(title)
-
-                result = spotify.search('artist:%s track:%s' % (artist, title), type='track')
-
-                track = pick_best_result(artist, title, album, result)
-
-            if not track:
-                # search by song title only, then match the artist after the fact
-                result = spotify.search('track:%s' % title, type='track')
-                
-                track = pick_best_result(artist, title, album, result)
+            track = find_track(spotify, song)
 
             if not track:
                 # can't find it
                 failed += 1
                 failed_songs.append(song)
+
+                if library_writer is not None:
+                    library_writer.resolve(song, None)
+
                 continue
 
             spotify_ids[local_id] = track['id']
 
+            if library_writer is not None:
+                library_writer.resolve(song, track['id'])
+
             found += 1
 
         print()
@@ -276,21 +669,7 @@ def import_library_from_json(username, client_id, client_secret, json_input):
         print("Failed to find %d tracks." % failed)
 
         if failed > 0:
-            unmatched_json = {
-                'songs': [
-                    {
-                        'artist': song.artist,
-                        'title': song.title,
-                        'album': song.album,
-                        'in_playlists': [pl.name for pl in song.playlists],
-                    } for song in failed_songs
-                ]
-            }
-
-            with open('unmatched.json', 'w') as unmatched_file:
-                json.dump(unmatched_json, unmatched_file, indent=2)
-
-            print("Wrote unmatched song info to unmatched.json.")
+            write_unmatched(failed_songs)
 
         with open(MAPPINGS_FILE_NAME, 'w+') as mappings_file:
             writer = csv.writer(mappings_file)
@@ -300,12 +679,22 @@ def import_library_from_json(username, client_id, client_secret, json_input):
             
             print("Wrote Spotify ID mappings to %s." % MAPPINGS_FILE_NAME)
 
+    if library_writer is not None:
+        print("Waiting for remaining library and playlist writes...")
+
+        library_writer.close()
+
+        print("Added %d matched songs to Spotify library." % library_writer.saved_count)
+        print("Generated %d playlists." % library_writer.playlist_count)
+
+        print("Done!")
+
+        return
+
     spotify_songs = unique({k:v for k, v in spotify_ids.items() if songs[k if k is UUID else UUID(k)].in_library}.values())
 
     print("Adding %d matched songs to Spotify library..." % len(spotify_songs))
 
-    PER_REQUEST = 50
-
     for i in range(0, ceil(len(spotify_songs) / PER_REQUEST)):
         songs_slice = spotify_songs[(i * PER_REQUEST):min((i + 1) * PER_REQUEST, len(spotify_songs))]
 
@@ -319,7 +708,7 @@ def import_library_from_json(username, client_id, client_secret, json_input):
     print("Generating %d playlists..." % len(playlists))
 
     for playlist in playlists:
-        playlist_id = spotify.user_playlist_create(user, playlist.name, public=False)['id']
+        playlist_id = spotify.user_playlist_create(username, playlist.name, public=False)['id']
 
         for i in range(0, ceil(len(playlist.songs) / PER_REQUEST)):
             songs_slice = [
@@ -331,7 +720,7 @@ def import_library_from_json(username, client_id, client_secret, json_input):
             if len(songs_slice) == 0:
                 break
 
-            spotify.user_playlist_add_tracks(user, playlist_id, songs_slice)
+            spotify.user_playlist_add_tracks(username, playlist_id, songs_slice)
 
     print("Finished generating playlists.")
 
@@ -339,11 +728,23 @@ def import_library_from_json(username, client_id, client_secret, json_input):
 
 
 if __name__ == '__main__':
-    user = input('Spotify username: ')
-    client_id = input('Spotify client ID: ')
-    client_secret = getpass('Spotify client secret: ')
-
-    print("secret!!!: <<%s>>" % client_secret)
+    parser = ArgumentParser(description="Import a library exported by gmusic2json.py to Spotify.")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="write to the library and playlists while matching instead of after it")
+    parser.add_argument('--validate-mappings', action='store_true',
+                        help="re-check cached Spotify mappings and re-match any which are no longer available")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the requests an import would make and how long it would take, then exit")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        with open('output_library.json', 'r') as json_file:
+            plan_import(json_file, args.pipelined, args.validate_mappings)
+    else:
+        user = input('Spotify username: ')
+        client_id = input('Spotify client ID: ')
+        client_secret = getpass('Spotify client secret: ')
 
-    with open('output_library.json', 'r') as json_file:
-        import_library_from_json(user, client_id, client_secret, json_file)
+        with open('output_library.json', 'r') as json_file:
+            import_library_from_json(user, client_id, client_secret, json_file, args.pipelined,
+                                     args.validate_mappings)
@@ -0,0 +1,63 @@
+from os import path
+import sys
+
+import pytest
+from spotipy import SpotifyException
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+
+def make_track(track_id, name, artist='Artist', album='Album'):
+    return {'id': track_id, 'name': name, 'artists': [{'name': artist}], 'album': {'name': album}}
+
+
+def make_result(*tracks):
+    return {'tracks': {'total': len(tracks), 'items': list(tracks)}}
+
+
+class FakeSpotify:
+    # stands in for spotipy.Spotify, recording every call made to it
+
+    def __init__(self, auth=None, search_results=None, tracks_results=None):
+        self.search_results = search_results if search_results is not None else {}
+        self.tracks_results = tracks_results if tracks_results is not None else {}
+        # IDs which Spotify rejects outright, failing any request they're part of
+        self.bad_ids = set()
+        # if set, every track lookup fails with this HTTP status
+        self.lookup_error_status = None
+        self.calls = []
+
+    def search(self, q, type='track'):
+        self.calls.append(('search', q))
+        return self.search_results.get(q, make_result())
+
+    def tracks(self, tracks, market=None):
+        self.calls.append(('tracks', list(tracks)))
+        if self.lookup_error_status is not None:
+            raise SpotifyException(self.lookup_error_status, -1, "lookup failed")
+        if self.bad_ids.intersection(tracks):
+            raise SpotifyException(400, -1, "invalid id")
+        return {'tracks': [self.tracks_results.get(track_id) for track_id in tracks]}
+
+    def track(self, track_id, market=None):
+        self.calls.append(('track', track_id))
+        if self.lookup_error_status is not None:
+            raise SpotifyException(self.lookup_error_status, -1, "lookup failed")
+        if track_id in self.bad_ids:
+            raise SpotifyException(400, -1, "invalid id")
+        return self.tracks_results.get(track_id)
+
+    def current_user_saved_tracks_add(self, tracks):
+        self.calls.append(('saved_tracks_add', list(tracks)))
+
+    def user_playlist_create(self, user, name, public=True):
+        self.calls.append(('playlist_create', name))
+        return {'id': name}
+
+    def user_playlist_add_tracks(self, user, playlist_id, tracks):
+        self.calls.append(('playlist_add', playlist_id, list(tracks)))
+
+
+@pytest.fixture
+def fake_spotify():
+    return FakeSpotify()
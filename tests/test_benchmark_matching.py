@@ -0,0 +1,124 @@
+import io
+import json
+
+import pytest
+
+import benchmark_matching
+from benchmark_matching import replay_corpus, record_corpus
+from conftest import FakeSpotify, make_result, make_track
+
+
+def entry(expected_id, responses, reviewed=True):
+    return {
+        'id': '00000000-0000-0000-0000-000000000001',
+        'artist': 'Artist',
+        'title': 'Title',
+        'album': 'Album',
+        'expected_id': expected_id,
+        'reviewed': reviewed,
+        'responses': responses,
+    }
+
+
+LIBRARY = {'songs': {'00000000-0000-0000-0000-000000000001': {
+    'artist': 'The Artist', 'title': 'Title (feat. Someone)', 'album': 'Album', 'in_library': True,
+}}}
+
+
+def record(monkeypatch, spotify, corpus_path):
+    monkeypatch.setattr(benchmark_matching, 'authenticate', lambda *args: 'token')
+    monkeypatch.setattr(benchmark_matching.spotipy, 'Spotify', lambda auth: spotify)
+
+    record_corpus('user', 'id', 'secret', io.StringIO(json.dumps(LIBRARY)), str(corpus_path))
+
+    with open(str(corpus_path), 'r') as corpus_file:
+        return json.load(corpus_file)['songs']
+
+
+def test_record_stores_every_pass(monkeypatch, tmp_path):
+    spotify = FakeSpotify(search_results={
+        'artist:Artist track:Title': make_result(make_track('id1', 'Title')),
+    })
+
+    recorded = record(monkeypatch, spotify, tmp_path / 'corpus.json')[0]
+
+    assert set(recorded['responses']) == {
+        'artist:The Artist track:Title (feat. Someone)',
+        'artist:Artist track:Title',
+        'track:Title',
+    }
+    assert recorded['expected_id'] == 'id1'
+    assert recorded['reviewed'] is False
+
+
+def test_record_keeps_reviewed_expected_ids(monkeypatch, tmp_path):
+    corpus_path = tmp_path / 'corpus.json'
+    corpus_path.write_text(json.dumps({'songs': [
+        entry('hand-checked', {}),
+        dict(entry('other', {}), id='00000000-0000-0000-0000-000000000002'),
+    ]}))
+
+    spotify = FakeSpotify(search_results={
+        'artist:Artist track:Title': make_result(make_track('id1', 'Title')),
+    })
+
+    recorded = record(monkeypatch, spotify, corpus_path)
+
+    assert [(e['expected_id'], e['reviewed']) for e in recorded] == [('hand-checked', True), ('other', True)]
+    # the re-recorded entry still gets fresh responses
+    assert 'track:Title' in recorded[0]['responses']
+
+
+def test_failed_recording_leaves_corpus_untouched(monkeypatch, tmp_path):
+    corpus_path = tmp_path / 'corpus.json'
+    original = json.dumps({'songs': [entry('hand-checked', {})]})
+    corpus_path.write_text(original)
+
+    spotify = FakeSpotify()
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("network down")
+
+    spotify.search = fail
+
+    with pytest.raises(ConnectionError):
+        record(monkeypatch, spotify, corpus_path)
+
+    assert corpus_path.read_text() == original
+
+
+def test_replay_falls_through_to_recorded_later_passes():
+    corpus = {'songs': [entry('id2', {
+        'artist:Artist track:Title': make_result(),
+        'track:Title': make_result(make_track('id2', 'Title')),
+    })]}
+
+    stats = replay_corpus(corpus)
+
+    assert stats['matches'] == 1
+    assert stats['searches_per_song'] == 3
+    # the sanitized query is identical to the raw one here, so every pass hits a recording
+    assert stats['unrecorded_searches'] == 0
+    assert stats['precision'] == 1
+    assert stats['recall'] == 1
+
+
+def test_replay_ignores_unreviewed_entries_for_accuracy():
+    responses = {'artist:Artist track:Title': make_result(make_track('id1', 'Title'))}
+    corpus = {'songs': [entry('id1', responses, reviewed=False), entry('other', responses)]}
+
+    stats = replay_corpus(corpus)
+
+    assert stats['matches'] == 2
+    assert stats['reviewed'] == 1
+    assert stats['precision'] == 0
+    assert stats['recall'] == 0
+
+
+def test_replay_without_reviewed_entries_has_no_accuracy():
+    corpus = {'songs': [entry('id1', {}, reviewed=False)]}
+
+    stats = replay_corpus(corpus)
+
+    assert stats['precision'] is None
+    assert stats['recall'] is None
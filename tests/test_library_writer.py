@@ -0,0 +1,157 @@
+import csv
+import io
+import json
+from threading import Event
+from uuid import UUID
+
+import pytest
+
+import json2spotify
+from json2spotify import MAPPINGS_FILE_NAME, PER_REQUEST, LibraryWriter, Playlist, Song, import_library_from_json
+from conftest import FakeSpotify, make_result, make_track
+
+
+def make_songs(count, in_library=True):
+    return [Song('song%d' % i, 'Artist', 'Title %d' % i, 'Album', in_library) for i in range(count)]
+
+
+def make_playlist(name, songs):
+    playlist = Playlist(name)
+    for song in songs:
+        playlist.add_song(song)
+        song.add_playlist(playlist)
+    return playlist
+
+
+def test_saved_tracks_flush_in_full_batches(fake_spotify):
+    songs = make_songs(PER_REQUEST * 2 + 5)
+
+    writer = LibraryWriter(fake_spotify, 'user', [])
+    writer.start()
+
+    for song in songs:
+        writer.resolve(song, 'sp-' + song.id)
+
+    writer.close()
+
+    batches = [call[1] for call in fake_spotify.calls if call[0] == 'saved_tracks_add']
+    assert [len(batch) for batch in batches] == [PER_REQUEST, PER_REQUEST, 5]
+    assert writer.saved_count == len(songs)
+
+
+def test_saved_tracks_skip_duplicates_and_non_library_songs(fake_spotify):
+    library_songs = make_songs(3)
+    playlist_only = Song('extra', 'Artist', 'Extra', 'Album', False)
+
+    writer = LibraryWriter(fake_spotify, 'user', [])
+    writer.start()
+
+    writer.resolve(library_songs[0], 'sp-a')
+    writer.resolve(library_songs[1], 'sp-a')
+    writer.resolve(library_songs[2], None)
+    writer.resolve(playlist_only, 'sp-b')
+
+    writer.close()
+
+    assert fake_spotify.calls == [('saved_tracks_add', ['sp-a'])]
+
+
+def test_playlists_are_written_once_all_songs_resolve(fake_spotify):
+    songs = make_songs(4)
+    first = make_playlist('first', songs[2:4])
+    second = make_playlist('second', songs[0:2])
+    empty = make_playlist('empty', [])
+
+    writer = LibraryWriter(fake_spotify, 'user', [first, second, empty])
+    writer.start()
+
+    for song, spotify_id in zip(songs, ['sp0', None, 'sp2', 'sp3']):
+        writer.resolve(song, spotify_id)
+
+    writer.close()
+
+    playlist_calls = [call for call in fake_spotify.calls if call[0] != 'saved_tracks_add']
+    assert playlist_calls == [
+        ('playlist_create', 'empty'),
+        ('playlist_create', 'second'),
+        ('playlist_add', 'second', ['sp0']),
+        ('playlist_create', 'first'),
+        ('playlist_add', 'first', ['sp2', 'sp3']),
+    ]
+    assert writer.playlist_count == 3
+
+
+def test_write_failure_is_reported(fake_spotify):
+    def fail(*args, **kwargs):
+        raise RuntimeError("insufficient scope")
+
+    fake_spotify.user_playlist_create = fail
+
+    writer = LibraryWriter(fake_spotify, 'user', [make_playlist('broken', [])])
+    writer.start()
+
+    # the writer thread exits as soon as the write fails
+    writer.thread.join(timeout=5)
+
+    assert writer.failed()
+
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+
+def test_pipelined_write_failure_keeps_mappings(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+    song_count = PER_REQUEST * 3
+    ids = [str(UUID(int=i + 1)) for i in range(song_count)]
+    export = {
+        'songs': {
+            local_id: {'artist': 'Artist', 'title': 'Title %d' % i, 'album': 'Album', 'in_library': True}
+            for i, local_id in enumerate(ids)
+        },
+        'playlists': [],
+    }
+
+    write_failed = Event()
+
+    class MatchingSpotify(FakeSpotify):
+        def search(self, q, type='track'):
+            # hold off on the songs past the first batch until the writer has failed on it
+            if len([call for call in self.calls if call[0] == 'search']) > PER_REQUEST:
+                write_failed.wait(timeout=5)
+            return FakeSpotify.search(self, q, type)
+
+    matching = MatchingSpotify(search_results={
+        'artist:Artist track:Title %d' % i: make_result(make_track('sp%d' % i, 'Title %d' % i))
+        for i in range(song_count)
+    })
+    writing = FakeSpotify()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("rate limited")
+
+    writing.current_user_saved_tracks_add = fail
+
+    run = LibraryWriter._run
+
+    def run_and_signal(self):
+        run(self)
+        write_failed.set()
+
+    monkeypatch.setattr(LibraryWriter, '_run', run_and_signal)
+
+    clients = iter([matching, writing])
+
+    monkeypatch.setattr(json2spotify, 'authenticate', lambda *args: 'token')
+    monkeypatch.setattr(json2spotify.spotipy, 'Spotify', lambda auth: next(clients))
+
+    with pytest.raises(RuntimeError):
+        import_library_from_json('user', 'id', 'secret', io.StringIO(json.dumps(export)), pipelined=True)
+
+    with open(MAPPINGS_FILE_NAME, 'r') as mappings_file:
+        mappings = dict(csv.reader(mappings_file))
+
+    # everything matched before the failure is kept, and matching stopped instead of running to the end
+    assert len(mappings) > PER_REQUEST
+    assert len(mappings) < song_count
+    assert all(mappings[ids[i]] == 'sp%d' % i for i in range(PER_REQUEST))
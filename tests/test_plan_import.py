@@ -0,0 +1,76 @@
+import io
+import json
+from uuid import UUID
+
+import pytest
+
+import json2spotify
+from json2spotify import MAPPINGS_FILE_NAME, plan_import
+
+
+@pytest.fixture(autouse=True)
+def planning_env(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # one second per request and a rate limit that never kicks in for sequential requests keeps the sums simple
+    monkeypatch.setattr(json2spotify, 'REQUEST_LATENCY', 1.0)
+    monkeypatch.setattr(json2spotify, 'RATE_LIMIT', 10)
+    monkeypatch.setattr(json2spotify, 'VALIDATION_WORKERS', 2)
+
+
+def make_export(song_count, library_count, playlist_sizes):
+    ids = [str(UUID(int=i + 1)) for i in range(song_count)]
+    return {
+        'songs': {
+            local_id: {'artist': 'Artist', 'title': 'Title', 'album': 'Album', 'in_library': i < library_count}
+            for i, local_id in enumerate(ids)
+        },
+        'playlists': [{'name': 'p%d' % i, 'songs': ids[:size]} for i, size in enumerate(playlist_sizes)],
+    }
+
+
+def plan(export, **kwargs):
+    return plan_import(io.StringIO(json.dumps(export)), **kwargs)
+
+
+def test_fresh_import_ranges():
+    result = plan(make_export(120, 110, [60, 5]))
+
+    assert result['lookups'] == 0
+    assert result['searches'] == (120, 360)
+    assert result['saved_batches'] == (0, 3)
+    assert result['playlist_creates'] == 2
+    assert result['playlist_adds'] == (0, 3)
+
+    # every song can still match on the last pass, so the worst case pays for all of the writes too
+    writes = 3 + 2 + 3
+    assert result['time'] == (120 + writes, 360 + writes)
+
+
+def test_cached_mappings_with_validation():
+    export = make_export(120, 110, [60])
+
+    with open(MAPPINGS_FILE_NAME, 'w') as mappings_file:
+        for i, local_id in enumerate(list(export['songs'])[:100]):
+            # pairs of songs share a track, which only gets saved once
+            mappings_file.write('%s,sp%d\n' % (local_id, i // 2))
+
+    result = plan(export, validate=True)
+
+    assert result['lookups'] == 2
+    assert result['searches'] == (0, 300)
+    assert result['saved_batches'] == (0, 1)
+    assert result['playlist_adds'] == (0, 2)
+
+    # two lookups spread over two workers, limited by latency rather than the rate limit
+    lookup_time = 2 * 0.5
+    writes = 1 + 1 + 2
+    assert result['time'] == (lookup_time + writes, lookup_time + 300 + writes)
+
+
+def test_pipelined_writes_share_the_rate_limit(monkeypatch):
+    monkeypatch.setattr(json2spotify, 'REQUEST_LATENCY', 0.01)
+
+    result = plan(make_export(100, 100, []), pipelined=True)
+
+    # 100 searches and 2 saved batches are bound by the rate limit as a whole rather than separately
+    assert result['time'] == (pytest.approx(102 / 10.0), pytest.approx(302 / 10.0))
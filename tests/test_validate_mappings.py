@@ -0,0 +1,120 @@
+from uuid import UUID
+
+import pytest
+from spotipy import SpotifyException
+
+from json2spotify import PER_REQUEST, Song, validate_mappings
+from conftest import make_result, make_track
+
+
+def make_library(count):
+    songs = {}
+    for i in range(count):
+        local_id = str(UUID(int=i + 1))
+        songs[UUID(local_id)] = Song(local_id, 'Artist', 'Title %d' % i, 'Album', True)
+    return songs
+
+
+def playable(track_id):
+    return {'id': track_id, 'is_playable': True}
+
+
+def test_lookups_are_chunked(fake_spotify):
+    songs = make_library(PER_REQUEST * 2 + 1)
+    spotify_ids = {song.id: 'sp-' + song.id for song in songs.values()}
+    fake_spotify.tracks_results = {v: playable(v) for v in spotify_ids.values()}
+
+    validate_mappings(fake_spotify, songs, spotify_ids, lambda: fake_spotify)
+
+    assert sorted(len(call[1]) for call in fake_spotify.calls) == [1, PER_REQUEST, PER_REQUEST]
+    assert spotify_ids == {song.id: 'sp-' + song.id for song in songs.values()}
+
+
+def test_relinked_and_invalid_mappings(fake_spotify, capsys):
+    songs = make_library(4)
+    ids = [song.id for song in songs.values()]
+
+    spotify_ids = {ids[0]: 'valid', ids[1]: 'old', ids[2]: 'removed', ids[3]: 'unplayable'}
+
+    fake_spotify.tracks_results = {
+        'valid': playable('valid'),
+        'old': {'id': 'new', 'is_playable': True, 'linked_from': {'id': 'old'}},
+        'unplayable': {'id': 'unplayable', 'is_playable': False},
+    }
+    # only the song whose track was removed turns up again on search
+    fake_spotify.search_results = {
+        'artist:Artist track:Title 2': make_result(make_track('rematched', 'Title 2')),
+    }
+
+    validate_mappings(fake_spotify, songs, spotify_ids, lambda: fake_spotify)
+
+    assert spotify_ids == {ids[0]: 'valid', ids[1]: 'new', ids[2]: 'rematched'}
+
+    searched = [call[1] for call in fake_spotify.calls if call[0] == 'search']
+    assert all('Title 0' not in q and 'Title 1' not in q for q in searched)
+
+    output = capsys.readouterr().out
+    assert "Relinked 1 mappings." in output
+    assert "Re-matched 1 tracks on Spotify." in output
+    assert "Failed to re-match 1 tracks." in output
+
+
+def test_mappings_for_removed_songs_are_not_counted_as_rematched(fake_spotify, capsys):
+    songs = make_library(1)
+    stale_id = str(UUID(int=1000))
+    spotify_ids = {stale_id: 'removed'}
+
+    validate_mappings(fake_spotify, songs, spotify_ids, lambda: fake_spotify)
+
+    assert spotify_ids == {}
+
+    output = capsys.readouterr().out
+    assert "Re-matched 0 tracks on Spotify." in output
+    assert "Dropped 1 mappings" in output
+
+
+def test_failed_chunk_falls_back_to_single_lookups(fake_spotify):
+    songs = make_library(3)
+    ids = [song.id for song in songs.values()]
+
+    spotify_ids = {ids[0]: 'a', ids[1]: 'malformed', ids[2]: 'b'}
+    fake_spotify.tracks_results = {'a': playable('a'), 'b': playable('b')}
+    fake_spotify.bad_ids = {'malformed'}
+
+    validate_mappings(fake_spotify, songs, spotify_ids, lambda: fake_spotify)
+
+    assert spotify_ids == {ids[0]: 'a', ids[2]: 'b'}
+    assert [call for call in fake_spotify.calls if call[0] == 'track'] == [
+        ('track', 'a'), ('track', 'malformed'), ('track', 'b'),
+    ]
+
+
+def test_each_worker_gets_its_own_client(fake_spotify):
+    songs = make_library(PER_REQUEST * 3)
+    spotify_ids = {song.id: song.id for song in songs.values()}
+    fake_spotify.tracks_results = {v: playable(v) for v in spotify_ids.values()}
+
+    created = []
+
+    def client_factory():
+        created.append(object())
+        return fake_spotify
+
+    validate_mappings(object(), songs, spotify_ids, client_factory)
+
+    # no more clients than threads, and the main thread's client is never used for lookups
+    assert 1 <= len(created) <= 3
+
+
+def test_rate_limiting_leaves_mappings_untouched(fake_spotify):
+    songs = make_library(3)
+    spotify_ids = {song.id: 'sp-' + song.id for song in songs.values()}
+    original = dict(spotify_ids)
+    fake_spotify.lookup_error_status = 429
+
+    with pytest.raises(SpotifyException):
+        validate_mappings(fake_spotify, songs, spotify_ids, lambda: fake_spotify)
+
+    assert spotify_ids == original
+    # no per-track fallback and no searches
+    assert [call[0] for call in fake_spotify.calls] == ['tracks']